@@ -4,6 +4,7 @@ Configures the GPU availability and path to the dataset
 
 GPU = True
 MULTI_GPU = False
+DISTRIBUTED = False  # one process per GPU (DistributedDataParallel), launch with torchrun
 kitti = "D:\\depthest\\"
 status = "kitti"
 datasets_path = kitti
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""
+Exports a trained depth estimation model to ONNX, e.g. to build a TensorRT engine for Jetson deployment:
+
+    trtexec --onnx=fastdepth.onnx --fp16 --saveEngine=fastdepth.engine
+"""
+
+import argparse
+import torch
+import torch.nn as nn
+import models
+
+
+def load_depth_estimation_model(checkpoint_path):
+    """
+    This function load the trained depth estimation model on the CPU
+    Parameters
+    ----------
+    checkpoint_path: path to the trained depth estimation model
+
+    Returns
+    -------
+    model: depth estimation model
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu') # load model checkpoint
+    if type(checkpoint) is dict:
+        model = checkpoint['model']
+        print("=> loaded best depth estimation model (epoch {})".format(checkpoint['epoch']))
+    else:
+        model = checkpoint
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module # unwrap multi GPU training models
+    return model
+
+
+def export_onnx(model, onnx_path, input_size=(224, 224), opset_version=13):
+    """
+    This function exports the model in eval mode with a fp32 NCHW input of batch size 1.
+    Every depthwise/pointwise block is exported as Conv(groups=C) -> ReLU -> Conv(1x1) -> ReLU
+    with the BatchNorm folded into the convs, the pattern TensorRT fuses into DepSepConvolution.
+    Every 2x nearest upsampling is exported as a single Resize.
+    Parameters
+    ----------
+    model: depth estimation model
+    onnx_path: path of the ONNX file
+    input_size: height and width of the input image
+    opset_version: ONNX opset
+
+    Returns
+    -------
+    None: nothing return. the ONNX graph is written to onnx_path
+    """
+    model = model.cpu().eval()
+    if hasattr(model, 'amp'):
+        model.amp = False # let TensorRT pick the precision of every layer
+    dummy_input = torch.randn(1, 3, input_size[0], input_size[1])
+    torch.onnx.export(model, dummy_input, onnx_path, opset_version=opset_version,
+                      input_names=['rgb'], output_names=['depth'], do_constant_folding=True)
+    print("=> exported ONNX model to '{}'".format(onnx_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Depth estimation ONNX export')
+    parser.add_argument('--model', default='', type=str, metavar='PATH',
+                        help='path to the trained checkpoint (default: untrained MobileNetSkipAdd)')
+    parser.add_argument('--output', default='fastdepth.onnx', type=str, metavar='PATH',
+                        help='path of the exported ONNX model (default: fastdepth.onnx)')
+    parser.add_argument('--opset', default=13, type=int,
+                        help='ONNX opset version (default: 13, use 17 with PyTorch >= 1.13)')
+    args = parser.parse_args()
+    print(args)
+
+    if args.model:
+        model = load_depth_estimation_model(args.model)
+    else:
+        model = models.MobileNetSkipAdd(output_size=(224, 224))
+    export_onnx(model, args.output, opset_version=args.opset)
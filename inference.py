@@ -19,6 +19,7 @@ cmap = plt.cm.viridis
 import time
 
 from dataloaders import transforms
+import models
 import argparse
 cudnn.benchmark = True
 
@@ -87,13 +88,14 @@ def img_transform(rgb):
 
 
 
-def depth_prediction(model,bgr_img):
+def depth_prediction(model,bgr_img,bf16=False):
     """
     This function predict the depth map from BGR image
     Parameters
     ----------
     model: depth estimation model
     bgr_img: BGR image
+    bf16: run the whole model under CPU bf16 autocast (needed for bf16 ipex models)
 
     Returns
     -------
@@ -110,18 +112,19 @@ def depth_prediction(model,bgr_img):
     input_tensor = input_tensor.unsqueeze(0) # add additional dimension
     if GPU==True:
         input_tensor=input_tensor.cuda()
-    with torch.no_grad():
-        pred_depth_tensor = model(input_tensor) # predicted depth map tensor
+    with torch.no_grad(), torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=bf16):
+        pred_depth_tensor = model(input_tensor).float() # predicted depth map tensor
     pred_depth,color_depth=colored_depthmap(pred_depth_tensor)
     return color_depth
 
-def run_model(model,source):
+def run_model(model,source,bf16=False):
     """
     This function run the inference
     Parameters
     ----------
     model: depth estimation model
     source: source of input such as image, video, webcam
+    bf16: run the whole model under CPU bf16 autocast
 
     Returns
     -------
@@ -134,7 +137,7 @@ def run_model(model,source):
         while success:
             success, image = videocap.read()
             start = time.time()
-            color_depth = depth_prediction(model,image)
+            color_depth = depth_prediction(model,image,bf16)
             end = time.time()
             totalTime = end - start
             fps = 1 / totalTime
@@ -161,9 +164,18 @@ parser.add_argument('--model', default='D:\\depthest\\results\\kitti.samples=0.m
                       type=str, metavar='PATH',
                       help='path to the pretrained checkpoint (default: '')')
 parser.add_argument('--source', default='webcam', metavar='DATA',help='type of source (webcam, image, video')
+parser.add_argument('--amp', action='store_true', help='run the decoder in fp16 (GPU) / bf16 (CPU) autocast')
+parser.add_argument('--ipex', action='store_true', help='optimize the model for Intel CPUs (intel_extension_for_pytorch)')
+parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile (PyTorch >= 2.0)')
 
 args = parser.parse_args()
 print(args)
 
 load_model = load_depth_estimation_model(args.model)
-run_model(load_model,args.source)
\ No newline at end of file
+if args.amp:
+    load_model.amp = True
+if args.ipex:
+    load_model = models.optimize_for_cpu(load_model)
+if args.compile:
+    load_model = models.compile_model(load_model.eval())
+run_model(load_model,args.source,bf16=args.ipex) # the ipex model has bf16 weights
\ No newline at end of file
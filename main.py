@@ -1,9 +1,11 @@
 import os
+import copy
 import time
 import csv
 import numpy as np
 import torch
 import torch.nn.parallel
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 import torch.optim
 import models as models
@@ -18,8 +20,10 @@ import utils
 args = utils.parse_command()
 print(args)
 
+local_rank = int(os.environ.get('LOCAL_RANK', 0))  # set by torchrun
 if config.GPU == True:
-    os.environ["CUDA_VISIBLE_DEVICES"] = '0'  # Set the GPU.
+    if not config.DISTRIBUTED:
+        os.environ["CUDA_VISIBLE_DEVICES"] = '0'  # Set the GPU.
 else:
     os.environ["CUDA_VISIBLE_DEVICES"] = ""  # Set the CPU
 fieldnames = ['rmse', 'mae', 'delta1', 'absrel',
@@ -32,6 +36,11 @@ best_result.set_to_worst()
 def worker_init_fn(work_id):
     np.random.seed(work_id)
 
+
+def is_main_process():
+    # only the first process writes results and checkpoints in distributed training
+    return not config.DISTRIBUTED or dist.get_rank() == 0
+
                                 
 def create_data_loaders(args):
     """
@@ -74,9 +83,12 @@ def create_data_loaders(args):
 
     # put construction of train loader here, for those who are interested in testing only
     if not args.evaluate:
+        # in distributed training every process loads its own shard of the data, batch size is per GPU
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset) \
+            if config.DISTRIBUTED else None
         train_loader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=args.batch_size, shuffle=True,
-            num_workers=args.workers, pin_memory=True, sampler=None,
+            train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+            num_workers=args.workers, pin_memory=True, sampler=train_sampler,
             worker_init_fn = worker_init_fn)
         # worker_init_fn ensures different sampling patterns for each data loading thread
 
@@ -91,6 +103,10 @@ def main():
     print(args)
     start = 0
 
+    if config.DISTRIBUTED:
+        dist.init_process_group(backend='nccl')
+        torch.cuda.set_device(local_rank)
+
     # evaluation mode
     if args.evaluate:
         assert os.path.isfile(args.evaluate), \
@@ -117,7 +133,10 @@ def main():
         chkpt_path = args.resume
         assert os.path.isfile(chkpt_path), "=> no checkpoint found at '{}'".format(chkpt_path)
         print("=> loading checkpoint '{}'".format(chkpt_path))
-        checkpoint = torch.load(chkpt_path)
+        if config.DISTRIBUTED:
+            checkpoint = torch.load(chkpt_path, map_location='cuda:{}'.format(local_rank))
+        else:
+            checkpoint = torch.load(chkpt_path)
         args = checkpoint['args']
         start_epoch = checkpoint['epoch'] + 1 # load epoch number
         start = start_epoch # resume from the checkpoint epoch
@@ -145,13 +164,23 @@ def main():
                                     momentum=args.momentum, weight_decay=args.weight_decay) # configure optimizer
 
         if config.GPU == True:
-            if config.MULTI_GPU == True:  # training on multiple GPU
+            if config.DISTRIBUTED:  # training on multiple GPU, one process per GPU
+                model = model.cuda()
+            elif config.MULTI_GPU == True:  # training on multiple GPU
                 model = torch.nn.DataParallel(model).cuda()
             else:  # training on single GPU
                 model = model.cuda()
         else:
             pass
 
+    if config.DISTRIBUTED:
+        # normalize over the global batch, the per GPU batch is too small for stable BatchNorm statistics
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        # the forward pass has no data dependent control flow, every parameter receives a gradient
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank],
+                                                          find_unused_parameters=False,
+                                                          gradient_as_bucket_view=True)
+
     # define loss function and optimizer
     if args.criterion == 'l2':
         if config.GPU == True:
@@ -167,14 +196,14 @@ def main():
     # create results folder, if not already exists
     output_directory = utils.get_output_directory(args)
 
-    if not os.path.exists(output_directory):  # create new directory
+    if is_main_process() and not os.path.exists(output_directory):  # create new directory
         os.makedirs(output_directory)
     train_csv = os.path.join(output_directory, 'train.csv')  # store training result
     test_csv = os.path.join(output_directory, 'test.csv')  # store test result
     best_txt = os.path.join(output_directory, 'best.txt')  # store best result
 
     # create new csv files with only header
-    if not args.resume:
+    if not args.resume and is_main_process():
         with open(train_csv, 'w') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
@@ -184,32 +213,44 @@ def main():
 
     # training is started from here
     for epoch in range(start, args.epochs):
+        if config.DISTRIBUTED:
+            train_loader.sampler.set_epoch(epoch)  # reshuffle the shards every epoch
         utils.adjust_learning_rate(optimizer, epoch, args.lr)
         train(train_loader, model, criterion, optimizer, epoch)  # train for one epoch
-        result, img_merge = validate(val_loader, model, epoch)  # evaluate on validation set
-
-        # remember best rmse and save checkpoint
-        is_best = result.rmse < best_result.rmse # compare result of the current epoch and best result
-        if is_best:
-            best_result = result
-            with open(best_txt, 'w') as txtfile:
-                txtfile.write(
-                    "epoch={}\nmse={:.3f}\nrmse={:.3f}\nabsrel={:.3f}\nlg10={:.3f}\nmae={:.3f}\ndelta1={:.3f}\ndelta2={:.3f}\ndelta3={:.3f}\nt_gpu={:.4f}\n".
-                        format(epoch, result.mse, result.rmse, result.absrel, result.lg10, result.mae,
-                               result.delta1, result.delta2, result.delta3,
-                               result.gpu_time))
-            if img_merge is not None:
-                img_filename = output_directory + '/comparison_best.png'
-                utils.save_image(img_merge, img_filename)
-
-        utils.save_checkpoint({
-            'args': args,
-            'epoch': epoch,
-            'arch': args.arch,
-            'model': model,
-            'best_result': best_result,
-            'optimizer': optimizer,
-        }, is_best, epoch, output_directory)
+        if is_main_process():  # only the first process validates and writes the checkpoint
+            if config.DISTRIBUTED:
+                # validate and save the plain model, without the DDP wrapper and with BatchNorm2d layers,
+                # copied together with the optimizer so that the saved optimizer still updates its parameters
+                model_to_save, optimizer_to_save = copy.deepcopy((model.module, optimizer))
+                model_to_save = models.revert_sync_batchnorm(model_to_save)
+            else:
+                model_to_save, optimizer_to_save = model, optimizer
+            result, img_merge = validate(val_loader, model_to_save, epoch)  # evaluate on validation set
+
+            # remember best rmse and save checkpoint
+            is_best = result.rmse < best_result.rmse # compare result of the current epoch and best result
+            if is_best:
+                best_result = result
+                with open(best_txt, 'w') as txtfile:
+                    txtfile.write(
+                        "epoch={}\nmse={:.3f}\nrmse={:.3f}\nabsrel={:.3f}\nlg10={:.3f}\nmae={:.3f}\ndelta1={:.3f}\ndelta2={:.3f}\ndelta3={:.3f}\nt_gpu={:.4f}\n".
+                            format(epoch, result.mse, result.rmse, result.absrel, result.lg10, result.mae,
+                                   result.delta1, result.delta2, result.delta3,
+                                   result.gpu_time))
+                if img_merge is not None:
+                    img_filename = output_directory + '/comparison_best.png'
+                    utils.save_image(img_merge, img_filename)
+
+            utils.save_checkpoint({
+                'args': args,
+                'epoch': epoch,
+                'arch': args.arch,
+                'model': model_to_save,
+                'best_result': best_result,
+                'optimizer': optimizer_to_save,
+            }, is_best, epoch, output_directory)
+        if config.DISTRIBUTED:
+            dist.barrier()  # the other processes wait for the checkpoint before the next epoch
 
         # utils.save_checkpoint({
         #     'state_dic': model.state_dict(),
@@ -287,6 +328,8 @@ def train(train_loader, model, criterion, optimizer, epoch):
                 gpu_time=gpu_time, result=result, average=average_meter.average()))
 
     avg = average_meter.average()
+    if not is_main_process():
+        return
     with open(train_csv, 'a') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writerow({'mse': avg.mse, 'rmse': avg.rmse, 'absrel': avg.absrel, 'lg10': avg.lg10,
@@ -390,3 +433,5 @@ def validate(val_loader, model, epoch, write_to_file=True):
 
 if __name__ == '__main__':
     main()
+    if config.DISTRIBUTED:
+        dist.destroy_process_group()
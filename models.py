@@ -1,10 +1,13 @@
 import os
+import re
+import inspect
 import torch
 import torch.nn as nn
 import torchvision.models
-import collections
+import pickle
 import math
 import torch.nn.functional as F
+import torch.fx
 import imagenet.mobilenet as imagenet
 
 class Identity(nn.Module):
@@ -22,32 +25,206 @@ class Unpool(nn.Module):
 
         self.stride = stride
 
-        # create kernel [1, 0; 0, 0]
-        self.mask = torch.zeros(1, 1, stride, stride)
-        self.mask[:,:,0,0] = 1
-
     def forward(self, x):
         assert x.dim() == 4
-        num_channels = x.size(1)
-        return F.conv_transpose2d(x,
-            self.mask.detach().type_as(x).expand(num_channels, 1, -1, -1),
-            stride=self.stride, groups=num_channels)
+        n, c, h, w = x.shape
+        s = self.stride
+        # place each input pixel at position (0,0) of its s*s block, zeros elsewhere
+        out = x.new_zeros(n, h*s, w*s, c).permute(0, 3, 1, 2) # channels_last
+        out[:, :, ::s, ::s] = x
+        return out
+
+def nn_up2(x):
+    # 2x nearest neighbour upsampling as a broadcast + copy, computed in NHWC so the
+    # output is channels_last like the rest of the model
+    if not torch.jit.is_scripting():
+        # a single Resize op in the ONNX graph, which TensorRT handles natively, and under FX
+        # tracing an op quantize_model can run in int8 (expand has no quantized kernel).
+        # TorchScript cannot compile is_in_onnx_export or the Proxy check
+        if torch.onnx.is_in_onnx_export() or isinstance(x, torch.fx.Proxy):
+            return F.interpolate(x, scale_factor=2, mode='nearest')
+    n, c, h, w = x.size(0), x.size(1), x.size(2), x.size(3)
+    x = x.permute(0, 2, 3, 1)[:, :, None, :, None, :].expand(n, h, 2, w, 2, c)
+    return x.reshape(n, 2*h, 2*w, c).permute(0, 3, 1, 2)
+
+def pixel_shuffle2(x):
+    # F.pixel_shuffle(x, 2) computed in NHWC: channel c*4 + i*2 + j goes to pixel (2h+i, 2w+j)
+    # of output channel c. The output is channels_last, like nn_up2
+    n, c, h, w = x.size(0), x.size(1), x.size(2), x.size(3)
+    x = x.permute(0, 2, 3, 1).reshape(n, h, w, c // 4, 2, 2)
+    x = x.permute(0, 1, 4, 2, 5, 3).reshape(n, 2*h, 2*w, c // 4)
+    return x.permute(0, 3, 1, 2)
+
+def skip_add(x, skip):
+    # in place in eager mode; under FX tracing keep an out-of-place add, whose result is
+    # used, so that quantize_model maps it to a quantized add instead of dropping it.
+    # TorchScript cannot compile the Proxy check, so it is skipped when scripting
+    if not torch.jit.is_scripting():
+        if isinstance(x, torch.fx.Proxy):
+            return x + skip
+    return x.add_(skip)
 
 def weights_init(m):
     # Initialize kernel weights with Gaussian distributions
     if isinstance(m, nn.Conv2d):
         n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-        m.weight.data.normal_(0, math.sqrt(2. / n))
+        nn.init.normal_(m.weight, 0, math.sqrt(2. / n))
         if m.bias is not None:
-            m.bias.data.zero_()
+            nn.init.zeros_(m.bias)
     elif isinstance(m, nn.ConvTranspose2d):
         n = m.kernel_size[0] * m.kernel_size[1] * m.in_channels
-        m.weight.data.normal_(0, math.sqrt(2. / n))
+        nn.init.normal_(m.weight, 0, math.sqrt(2. / n))
         if m.bias is not None:
-            m.bias.data.zero_()
+            nn.init.zeros_(m.bias)
     elif isinstance(m, nn.BatchNorm2d):
-        m.weight.data.fill_(1)
-        m.bias.data.zero_()
+        nn.init.ones_(m.weight)
+        nn.init.zeros_(m.bias)
+    elif isinstance(m, upproj):
+        # conv_in holds the 5*5 convs of both branches, give each the std of a conv with out_channels outputs
+        # (apply() visits the children first, so this overrides the plain Conv2d init above)
+        n = m.conv_in[0].kernel_size[0] * m.conv_in[0].kernel_size[1] * m.out_channels
+        nn.init.normal_(m.conv_in[0].weight, 0, math.sqrt(2. / n))
+
+def fold_bn(conv, bn):
+    # fold an eval-mode BatchNorm2d into the weight/bias of the preceding (transposed) conv
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    weight = conv.weight.detach()
+    if isinstance(conv, nn.ConvTranspose2d):
+        # weight layout: [in, out/groups, kh, kw]
+        g = conv.groups
+        w = weight.reshape(g, weight.size(0) // g, weight.size(1), *weight.shape[2:])
+        w = w * scale.reshape(g, 1, -1, 1, 1)
+        weight = w.reshape(weight.shape)
+    else:
+        weight = weight * scale.reshape(-1, 1, 1, 1)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    bias = (bias - bn.running_mean) * scale + bn.bias.detach()
+    with torch.no_grad():
+        conv.weight.copy_(weight) # keeps the memory format of the weight
+    conv.bias = nn.Parameter(bias)
+    return conv
+
+def fuse_model(model):
+    # fold every Conv2d/ConvTranspose2d -> BatchNorm2d pair of the nn.Sequential blocks,
+    # replacing the BatchNorm2d by an Identity. Only valid at inference time.
+    model.eval()
+    for m in model.modules():
+        if not isinstance(m, nn.Sequential):
+            continue
+        names = list(m._modules.keys())
+        for prev, name in zip(names[:-1], names[1:]):
+            if isinstance(m._modules[prev], (nn.Conv2d, nn.ConvTranspose2d)) \
+                    and isinstance(m._modules[name], nn.BatchNorm2d):
+                fold_bn(m._modules[prev], m._modules[name])
+                m._modules[name] = Identity()
+    return model
+
+def revert_sync_batchnorm(module):
+    # inverse of nn.SyncBatchNorm.convert_sync_batchnorm, sharing the parameters and statistics, so that
+    # models trained with DDP are saved with the BatchNorm2d layers fuse_model and quantization expect
+    module_output = module
+    if isinstance(module, nn.SyncBatchNorm):
+        module_output = nn.BatchNorm2d(module.num_features, module.eps, module.momentum,
+                                       module.affine, module.track_running_stats)
+        if module.affine:
+            module_output.weight = module.weight
+            module_output.bias = module.bias
+        module_output.running_mean = module.running_mean
+        module_output.running_var = module.running_var
+        module_output.num_batches_tracked = module.num_batches_tracked
+        module_output.train(module.training)
+    for name, child in module.named_children():
+        module_output.add_module(name, revert_sync_batchnorm(child))
+    return module_output
+
+def fuse_conv_relu(block):
+    # turn a folded pointwise() block (Conv2d, Identity, ReLU) into a single ConvReLU2d, which
+    # torch.compile / TorchScript freezing dispatch to a fused conv+relu kernel
+    try:
+        from torch.ao.nn.intrinsic import ConvReLU2d
+    except ImportError: # PyTorch < 1.13
+        from torch.nn.intrinsic import ConvReLU2d
+    if isinstance(block, ConvReLU2d): # already fused
+        return block
+    return ConvReLU2d(block[0], block[2])
+
+def fusible_groups(model):
+    # names of the [Conv2d, BatchNorm2d(, ReLU)] runs of the nn.Sequential blocks, in the format
+    # expected by torch.ao.quantization.fuse_modules. ReLU6 (encoder) is not fusible and left out.
+    groups = []
+    for name, m in model.named_modules():
+        if not isinstance(m, nn.Sequential):
+            continue
+        prefix = name + '.' if name else ''
+        children = list(m.named_children())
+        for i in range(len(children) - 1):
+            if isinstance(children[i][1], nn.Conv2d) and isinstance(children[i+1][1], nn.BatchNorm2d):
+                group = [prefix + children[i][0], prefix + children[i+1][0]]
+                if i + 2 < len(children) and type(children[i+2][1]) is nn.ReLU:
+                    group.append(prefix + children[i+2][0])
+                groups.append(group)
+    return groups
+
+def fuse_for_quantization(model, qat=False):
+    # fuse into ConvBnReLU2d/ConvBn2d (quantization aware training) or ConvReLU2d/Conv2d (post training)
+    from torch.ao.quantization import fuse_modules, fuse_modules_qat
+    if qat:
+        model.train()
+        return fuse_modules_qat(model, fusible_groups(model), inplace=True)
+    model.eval()
+    return fuse_modules(model, fusible_groups(model), inplace=True)
+
+def _prepare_fx(model, qconfig, example_input, qat=False):
+    # insert the observers (post training) or fake quantization modules (quantization aware training)
+    from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx
+    prepare = prepare_qat_fx if qat else prepare_fx
+    qconfig = {'': qconfig}
+    # Unpool writes into a slice of a new tensor, which symbolic tracing cannot follow
+    custom_config = {'non_traceable_module_class': [Unpool]}
+    if 'example_inputs' in inspect.signature(prepare).parameters: # PyTorch >= 1.13
+        return prepare(model, qconfig, example_inputs=(example_input,), prepare_custom_config=custom_config)
+    return prepare(model, qconfig, prepare_custom_config_dict=custom_config)
+
+def quantize_model(model, calibration_loader, backend='fbgemm', num_batches=32):
+    # post training static int8 quantization (FX graph mode), calibrated on (input, target) batches.
+    # model and batches must be on the CPU; use backend='qnnpack' for ARM / mobile.
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx
+    torch.backends.quantized.engine = backend
+    fuse_for_quantization(model)
+    example_input, _ = next(iter(calibration_loader))
+    prepared = _prepare_fx(model, get_default_qconfig(backend), example_input)
+    with torch.no_grad():
+        for i, (input, _) in enumerate(calibration_loader):
+            if i == num_batches:
+                break
+            prepared(input)
+    return convert_fx(prepared)
+
+def prepare_qat(model, example_input, backend='fbgemm'):
+    # quantization aware training (FX graph mode): returns the model with ConvBn(ReLU)2d modules and
+    # fake quantization, to be fine-tuned as usual and then converted to int8 on the CPU with
+    # torch.ao.quantization.quantize_fx.convert_fx(model.eval())
+    from torch.ao.quantization import get_default_qat_qconfig
+    torch.backends.quantized.engine = backend
+    fuse_for_quantization(model, qat=True)
+    return _prepare_fx(model, get_default_qat_qconfig(backend), example_input, qat=True)
+
+def compile_model(model, mode='reduce-overhead'):
+    # fuse conv/bn/relu/upsample kernels with torch.compile (PyTorch >= 2.0). 'reduce-overhead'
+    # additionally replays the whole graph as a CUDA graph, removing the per-layer launch latency.
+    if not hasattr(torch, 'compile'):
+        print("=> torch.compile is not available in PyTorch {}, running in eager mode".format(torch.__version__))
+        return model
+    return torch.compile(model, mode=mode, fullgraph=True)
+
+def optimize_for_cpu(model, dtype=torch.bfloat16):
+    # fold the BatchNorms, then let intel_extension_for_pytorch prepack every conv weight into
+    # the oneDNN blocked layout. Only needed for inference on Intel CPUs, hence imported here.
+    # With dtype=torch.bfloat16 the model must be called under torch.autocast('cpu', dtype=torch.bfloat16).
+    import intel_extension_for_pytorch as ipex
+    model = fuse_model(model)
+    return ipex.optimize(model, dtype=dtype)
 
 def conv(in_channels, out_channels, kernel_size):
     padding = (kernel_size-1) // 2
@@ -74,6 +251,13 @@ def pointwise(in_channels, out_channels):
           nn.ReLU(inplace=True),
         )
 
+def ds_block(in_channels, out_channels, kernel_size):
+    # depthwise separable block: depthwise conv followed by pointwise conv
+    return nn.Sequential(
+          depthwise(in_channels, kernel_size),
+          pointwise(in_channels, out_channels),
+        )
+
 def convt(in_channels, out_channels, kernel_size):
     stride = 2
     padding = (kernel_size - 1) // 2
@@ -103,47 +287,80 @@ def upconv(in_channels, out_channels):
         Unpool(2),
         nn.Conv2d(in_channels,out_channels,kernel_size=5,stride=1,padding=2,bias=False),
         nn.BatchNorm2d(out_channels),
-        nn.ReLU(),
+        nn.ReLU(inplace=True),
     )
 
 class upproj(nn.Module):
     # UpProj module has two branches, with a Unpool at the start and a ReLu at the end
     #   upper branch: 5*5 conv -> batchnorm -> ReLU -> 3*3 conv -> batchnorm
     #   bottom branch: 5*5 conv -> batchnorm
+    # both branches start with a 5*5 conv on the same input, computed here as a single conv
+    # with 2*out_channels outputs: channels [:out_channels] feed the upper branch, the rest the bottom one
 
     def __init__(self, in_channels, out_channels):
         super(upproj, self).__init__()
+        self.out_channels = out_channels
         self.unpool = Unpool(2)
-        self.branch1 = nn.Sequential(
-            nn.Conv2d(in_channels,out_channels,kernel_size=5,stride=1,padding=2,bias=False),
-            nn.BatchNorm2d(out_channels),
-            nn.ReLU(inplace=True),
-            nn.Conv2d(out_channels,out_channels,kernel_size=3,stride=1,padding=1,bias=False),
-            nn.BatchNorm2d(out_channels),
+        self.conv_in = nn.Sequential(
+            nn.Conv2d(in_channels,2*out_channels,kernel_size=5,stride=1,padding=2,bias=False),
+            nn.BatchNorm2d(2*out_channels),
         )
-        self.branch2 = nn.Sequential(
-            nn.Conv2d(in_channels,out_channels,kernel_size=5,stride=1,padding=2,bias=False),
+        self.conv2 = nn.Sequential(
+            nn.Conv2d(out_channels,out_channels,kernel_size=3,stride=1,padding=1,bias=False),
             nn.BatchNorm2d(out_channels),
         )
 
     def forward(self, x):
-        x = self.unpool(x)
-        x1 = self.branch1(x)
-        x2 = self.branch2(x)
-        return F.relu(x1 + x2)
+        x = self.conv_in(self.unpool(x))
+        c = self.out_channels
+        x1 = x[:, :c].contiguous(memory_format=torch.channels_last)
+        x2 = x[:, c:].contiguous(memory_format=torch.channels_last)
+        x1 = self.conv2(F.relu(x1))
+        return F.relu(skip_add(x1, x2), inplace=True)
+
+    def __setstate__(self, state):
+        super(upproj, self).__setstate__(state)
+        # models pickled before the 5*5 convs were merged hold branch1 and branch2
+        if 'branch1' in self._modules:
+            branch1, branch2 = self._modules.pop('branch1'), self._modules.pop('branch2')
+            conv1, bn1, conv2, bn2 = branch1[0], branch1[1], branch2[0], branch2[1]
+            self.out_channels = conv1.out_channels
+            conv = nn.Conv2d(conv1.in_channels,2*self.out_channels,kernel_size=5,stride=1,padding=2,bias=False)
+            bn = nn.BatchNorm2d(2*self.out_channels, eps=bn1.eps, momentum=bn1.momentum)
+            with torch.no_grad():
+                conv.weight.copy_(torch.cat([conv1.weight, conv2.weight]))
+                bn.weight.copy_(torch.cat([bn1.weight, bn2.weight]))
+                bn.bias.copy_(torch.cat([bn1.bias, bn2.bias]))
+                bn.running_mean.copy_(torch.cat([bn1.running_mean, bn2.running_mean]))
+                bn.running_var.copy_(torch.cat([bn1.running_var, bn2.running_var]))
+                bn.num_batches_tracked.copy_(bn1.num_batches_tracked)
+            self.conv_in = nn.Sequential(conv, bn).to(conv1.weight.device).train(self.training)
+            self.conv2 = nn.Sequential(branch1[3], branch1[4])
 
 class Decoder(nn.Module):
-    names = ['deconv{}{}'.format(i,dw) for i in range(3,10,2) for dw in ['', 'dw']]
-    names.append("deconv2") # default decoder
-    names.append("upconv")
-    names.append("upproj")
-    for i in range(3,10,2):
-        for dw in ['', 'dw']:
-            names.append("nnconv{}{}".format(i, dw))
-            names.append("blconv{}{}".format(i, dw))
-            names.append("shuffle{}{}".format(i, dw))
-
-class DeConv(nn.Module):
+    # base class of all decoders
+    @classmethod
+    def names(cls):
+        names = ['deconv{}{}'.format(i,dw) for i in range(3,10,2) for dw in ['', 'dw']]
+        names.append("deconv2") # default decoder
+        names.append("upconv")
+        names.append("upproj")
+        for i in range(3,10,2):
+            for dw in ['', 'dw']:
+                names.append("nnconv{}{}".format(i, dw))
+                names.append("blconv{}{}".format(i, dw))
+                names.append("shuffle{}{}".format(i, dw))
+        return names
+
+    def fuse_model(self):
+        fuse_model(self)
+        # final pointwise conv that outputs the depth map
+        for name in ['convf', 'conv6']:
+            if name in self._modules:
+                setattr(self, name, fuse_conv_relu(self._modules[name]))
+        return self
+
+class DeConv(Decoder):
 
     def __init__(self, kernel_size, dw):
         super(DeConv, self).__init__()
@@ -181,7 +398,7 @@ class DeConv(nn.Module):
         return x
 
 
-class UpConv(nn.Module):
+class UpConv(Decoder):
 
     def __init__(self):
         super(UpConv, self).__init__()
@@ -201,7 +418,7 @@ class UpConv(nn.Module):
         x = self.convf(x)
         return x
 
-class UpProj(nn.Module):
+class UpProj(Decoder):
     # UpProj decoder consists of 4 upproj modules with decreasing number of channels and increasing feature map size
 
     def __init__(self):
@@ -222,26 +439,16 @@ class UpProj(nn.Module):
         x = self.convf(x)
         return x
 
-class NNConv(nn.Module):
+class NNConv(Decoder):
 
     def __init__(self, kernel_size, dw):
         super(NNConv, self).__init__()
         if dw:
-            self.conv1 = nn.Sequential(
-                depthwise(960, kernel_size),
-                pointwise(960, 480))
-            self.conv2 = nn.Sequential(
-                depthwise(480, kernel_size),
-                pointwise(480, 240))
-            self.conv3 = nn.Sequential(
-                depthwise(240, kernel_size),
-                pointwise(240, 120))
-            self.conv4 = nn.Sequential(
-                depthwise(120, kernel_size),
-                pointwise(120, 60))
-            self.conv5 = nn.Sequential(
-                depthwise(60, kernel_size),
-                pointwise(60, 30))
+            self.conv1 = ds_block(960, 480, kernel_size)
+            self.conv2 = ds_block(480, 240, kernel_size)
+            self.conv3 = ds_block(240, 120, kernel_size)
+            self.conv4 = ds_block(120, 60, kernel_size)
+            self.conv5 = ds_block(60, 30, kernel_size)
             self.conv6 = pointwise(30, 1)
         else:
             self.conv1 = conv(960, 480, kernel_size)
@@ -253,19 +460,19 @@ class NNConv(nn.Module):
 
     def forward(self, x):
         x = self.conv1(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = nn_up2(x)
 
         x = self.conv2(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = nn_up2(x)
 
         x = self.conv3(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = nn_up2(x)
 
         x = self.conv4(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = nn_up2(x)
 
         x = self.conv5(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = nn_up2(x)
 
         x = self.conv6(x)
         return x
@@ -294,23 +501,15 @@ class BLConv(NNConv):
         x = self.conv6(x)
         return x
 
-class ShuffleConv(nn.Module):
+class ShuffleConv(Decoder):
 
     def __init__(self, kernel_size, dw):
         super(ShuffleConv, self).__init__()
         if dw:
-            self.conv1 = nn.Sequential(
-                depthwise(256, kernel_size),
-                pointwise(256, 256))
-            self.conv2 = nn.Sequential(
-                depthwise(64, kernel_size),
-                pointwise(64, 64))
-            self.conv3 = nn.Sequential(
-                depthwise(16, kernel_size),
-                pointwise(16, 16))
-            self.conv4 = nn.Sequential(
-                depthwise(4, kernel_size),
-                pointwise(4, 4))
+            self.conv1 = ds_block(256, 256, kernel_size)
+            self.conv2 = ds_block(64, 64, kernel_size)
+            self.conv3 = ds_block(16, 16, kernel_size)
+            self.conv4 = ds_block(4, 4, kernel_size)
         else:
             self.conv1 = conv(256, 256, kernel_size)
             self.conv2 = conv(64, 64, kernel_size)
@@ -318,125 +517,154 @@ class ShuffleConv(nn.Module):
             self.conv4 = conv(4, 4, kernel_size)
 
     def forward(self, x):
-        x = F.pixel_shuffle(x, 2)
+        x = pixel_shuffle2(x)
         x = self.conv1(x)
 
-        x = F.pixel_shuffle(x, 2)
+        x = pixel_shuffle2(x)
         x = self.conv2(x)
 
-        x = F.pixel_shuffle(x, 2)
+        x = pixel_shuffle2(x)
         x = self.conv3(x)
 
-        x = F.pixel_shuffle(x, 2)
+        x = pixel_shuffle2(x)
         x = self.conv4(x)
 
-        x = F.pixel_shuffle(x, 2)
+        x = pixel_shuffle2(x)
         return x
 
+# decoder name: <type><kernel_size>[dw], or upconv / upproj
+_DECODER_NAME = re.compile(r'(deconv|nnconv|blconv|shuffle)(\d)(dw)?|(upconv|upproj)')
+_DECODERS = {
+    'deconv': DeConv,
+    'nnconv': NNConv,
+    'blconv': BLConv,
+    'shuffle': ShuffleConv,
+    'upconv': lambda kernel_size, dw: UpConv(),
+    'upproj': lambda kernel_size, dw: UpProj(),
+}
+
 def choose_decoder(decoder):
-    depthwise = ('dw' in decoder)
-    if decoder[:6] == 'deconv':
-        assert len(decoder)==7 or (len(decoder)==9 and 'dw' in decoder)
-        kernel_size = int(decoder[6])
-        model = DeConv(kernel_size, depthwise)
-    elif decoder == "upproj":
-        model = UpProj()
-    elif decoder == "upconv":
-        model = UpConv()
-    elif decoder[:7] == 'shuffle':
-        assert len(decoder)==8 or (len(decoder)==10 and 'dw' in decoder)
-        kernel_size = int(decoder[7])
-        model = ShuffleConv(kernel_size, depthwise)
-    elif decoder[:6] == 'nnconv':
-        assert len(decoder)==7 or (len(decoder)==9 and 'dw' in decoder)
-        kernel_size = int(decoder[6])
-        model = NNConv(kernel_size, depthwise)
-    elif decoder[:6] == 'blconv':
-        assert len(decoder)==7 or (len(decoder)==9 and 'dw' in decoder)
-        kernel_size = int(decoder[6])
-        model = BLConv(kernel_size, depthwise)
+    match = _DECODER_NAME.fullmatch(decoder)
+    if match is None:
+        raise RuntimeError("invalid option for decoder: {}".format(decoder))
+    name, kernel_size, dw, fixed = match.groups()
+    if fixed is not None:
+        model = _DECODERS[fixed](None, False)
     else:
-        assert False, "invalid option for decoder: {}".format(decoder)
+        model = _DECODERS[name](int(kernel_size), dw is not None)
     model.apply(weights_init)
+    model.to(memory_format=torch.channels_last)
     return model
 
 
 class MobileNetSkipAdd(nn.Module):
-    def __init__(self, output_size, pretrained=True):
+    def __init__(self, output_size, pretrained=True, amp=False):
 
         super(MobileNetSkipAdd, self).__init__()
         self.output_size = output_size
+        self.amp = amp # run the decoder under fp16 (GPU) / bf16 (CPU) autocast
         mobilenet = imagenet.MobileNet()
         if pretrained:
             pretrained_path = os.path.join('imagenet', 'pretrained', 'model_best.pth.tar')
-            checkpoint = torch.load(pretrained_path)
-            state_dict = checkpoint['state_dict']
-
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                name = k[7:] # remove `module.`
-                new_state_dict[name] = v
-            mobilenet.load_state_dict(new_state_dict)
+            try:
+                # memory-map the tensors instead of reading the whole file (PyTorch >= 2.1, zipfile format)
+                checkpoint = torch.load(pretrained_path, map_location='cpu', mmap=True, weights_only=True)
+            except (TypeError, RuntimeError, pickle.UnpicklingError):
+                # older PyTorch or legacy serialization format
+                checkpoint = torch.load(pretrained_path, map_location='cpu')
+            state_dict = {k[7:] if k.startswith('module.') else k: v # remove `module.`
+                          for k, v in checkpoint['state_dict'].items()}
+            mobilenet.load_state_dict(state_dict)
         else:
             mobilenet.apply(weights_init)
 
-        for i in range(14):
-            setattr( self, 'conv{}'.format(i), mobilenet.model[i])
+        self.encoder = nn.ModuleList([mobilenet.model[i] for i in range(14)])
 
         kernel_size = 5
-        # self.decode_conv1 = conv(1024, 512, kernel_size)
-        # self.decode_conv2 = conv(512, 256, kernel_size)
-        # self.decode_conv3 = conv(256, 128, kernel_size)
-        # self.decode_conv4 = conv(128, 64, kernel_size)
-        # self.decode_conv5 = conv(64, 32, kernel_size)
-        self.decode_conv1 = nn.Sequential(
-            depthwise(1024, kernel_size),
-            pointwise(1024, 512))
-        self.decode_conv2 = nn.Sequential(
-            depthwise(512, kernel_size),
-            pointwise(512, 256))
-        self.decode_conv3 = nn.Sequential(
-            depthwise(256, kernel_size),
-            pointwise(256, 128))
-        self.decode_conv4 = nn.Sequential(
-            depthwise(128, kernel_size),
-            pointwise(128, 64))
-        self.decode_conv5 = nn.Sequential(
-            depthwise(64, kernel_size),
-            pointwise(64, 32))
+        # self.decode = nn.ModuleList([
+        #     conv(1024, 512, kernel_size),
+        #     conv(512, 256, kernel_size),
+        #     conv(256, 128, kernel_size),
+        #     conv(128, 64, kernel_size),
+        #     conv(64, 32, kernel_size)])
+        self.decode = nn.ModuleList([
+            ds_block(1024, 512, kernel_size),
+            ds_block(512, 256, kernel_size),
+            ds_block(256, 128, kernel_size),
+            ds_block(128, 64, kernel_size),
+            ds_block(64, 32, kernel_size)])
         self.decode_conv6 = pointwise(32, 1)
-        weights_init(self.decode_conv1)
-        weights_init(self.decode_conv2)
-        weights_init(self.decode_conv3)
-        weights_init(self.decode_conv4)
-        weights_init(self.decode_conv5)
+        for layer in self.decode:
+            weights_init(layer)
         weights_init(self.decode_conv6)
 
+        # run every conv/bn/relu on NHWC kernels (cuDNN / oneDNN)
+        self.to(memory_format=torch.channels_last)
+
+    def __setstate__(self, state):
+        super(MobileNetSkipAdd, self).__setstate__(state)
+        # models pickled before the ModuleList refactor hold conv0..conv13 and decode_conv1..decode_conv5
+        if 'encoder' not in self._modules:
+            self.encoder = nn.ModuleList([self._modules.pop('conv{}'.format(i)) for i in range(14)])
+            self.decode = nn.ModuleList([self._modules.pop('decode_conv{}'.format(i)) for i in range(1, 6)])
+        if 'amp' not in self.__dict__:
+            self.amp = False
+
+    def fuse_model(self):
+        fuse_model(self)
+        self.decode_conv6 = fuse_conv_relu(self.decode_conv6)
+        return self
+
+    def decode_skip(self, x, x1, x2, x3):
+        # decoder stages 1-5 with nearest upsampling and the skip additions from the encoder
+        x = self.decode[0](x)
+        x = nn_up2(x)
+        x = self.decode[1](x)
+        x = nn_up2(x)
+        x = skip_add(x, x3)
+        x = self.decode[2](x)
+        x = nn_up2(x)
+        x = skip_add(x, x2)
+        x = self.decode[3](x)
+        x = nn_up2(x)
+        x = skip_add(x, x1)
+        x = self.decode[4](x)
+        x = nn_up2(x)
+        return x
+
     def forward(self, x):
         # skip connections: dec4: enc1
         # dec 3: enc2 or enc3
         # dec 2: enc4 or enc5
-        for i in range(14):
-            layer = getattr(self, 'conv{}'.format(i))
-            x = layer(x)
-            # print("{}: {}".format(i, x.size()))
-            if i==1:
-                x1 = x
-            elif i==3:
-                x2 = x
-            elif i==5:
-                x3 = x
-        for i in range(1,6):
-            layer = getattr(self, 'decode_conv{}'.format(i))
-            x = layer(x)
-            x = F.interpolate(x, scale_factor=2, mode='nearest')
-            if i==4:
-                x = x + x1
-            elif i==3:
-                x = x + x2
-            elif i==2:
-                x = x + x3
-            # print("{}: {}".format(i, x.size()))
+        x = x.contiguous(memory_format=torch.channels_last)
+        x = self.encoder[0](x)
+        x = self.encoder[1](x)
+        x1 = x
+        x = self.encoder[2](x)
+        x = self.encoder[3](x)
+        x2 = x
+        x = self.encoder[4](x)
+        x = self.encoder[5](x)
+        x3 = x
+        x = self.encoder[6](x)
+        x = self.encoder[7](x)
+        x = self.encoder[8](x)
+        x = self.encoder[9](x)
+        x = self.encoder[10](x)
+        x = self.encoder[11](x)
+        x = self.encoder[12](x)
+        x = self.encoder[13](x)
+
+        if self.amp:
+            # constant autocast arguments, as required by TorchScript
+            if x.is_cuda:
+                with torch.autocast(device_type='cuda', dtype=torch.float16):
+                    x = self.decode_skip(x, x1, x2, x3)
+            else:
+                with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+                    x = self.decode_skip(x, x1, x2, x3)
+            x = x.float() # the final depth regression stays in fp32
+        else:
+            x = self.decode_skip(x, x1, x2, x3)
         x = self.decode_conv6(x)
         return x
@@ -16,7 +16,7 @@ def parse_command():
     data_names = ['kitti']
     model_names = ['MobileNetSkipAdd']
     loss_names = ['l1', 'l2']
-    decoder_names = Decoder.names
+    decoder_names = Decoder.names()
     modality_names = MyDataloader.modality_names
 
     parser = argparse.ArgumentParser(description='FastDepth')